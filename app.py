@@ -1,15 +1,27 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import lzma
 import tarfile
 import struct
 import os
 import shutil
-import glob
+import copy
 import io
+import mmap
 import time
 import hashlib
+import subprocess
+import threading
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import blake3 # 任意: SIMD・マルチスレッド対応の高速ハッシュ
+except ImportError:
+    blake3 = None
+
 # ==========================================
 # ⚙️ 設定・定数
 # ==========================================
@@ -23,6 +35,29 @@ DIR_INPUT_COMPRESSED = "workspace/input_compressed"
 DIR_EXTRACTED = "workspace/extracted_output"
 ALL_DIRS = [DIR_INPUT_RAW, DIR_OUTPUT_ARCHIVE, DIR_INPUT_COMPRESSED, DIR_EXTRACTED]
 
+# tar書き込みバッファ (1MB単位でLZMAへ供給し、read/write回数を削減)
+TAR_BUFSIZE = 1024 * 1024
+
+# LZMA辞書サイズの範囲 (入力サイズに合わせて自動調整)
+MIN_DICT_SIZE = 1024 * 1024 # 1MB
+MAX_DICT_SIZE = 256 * 1024 * 1024 # 256MB
+
+# ファイル形式の判定 (先頭バイトのシグネチャ -> 形式名)
+MAGIC_SIGNATURES = (
+    (b'%PDF', "pdf"), (b'\x7fELF', "elf"), (b'MZ', "exe"),
+    (b'\x89PNG', "png"), (b'\xff\xd8\xff', "jpeg"), (b'GIF8', "gif"), (b'OggS', "ogg"),
+    (b'PK\x03\x04', "zip"), (b'\x1f\x8b', "gzip"), (b'\xfd7zXZ\x00', "xz"),
+    (b"7z\xbc\xaf'\x1c", "7z"), (b'\x28\xb5\x2f\xfd', "zstd"), (b'MYCP', "mycmp"),
+)
+
+# 圧縮済み形式 (LZMAでほぼ縮まないため、アーカイブ末尾にまとめる)
+INCOMPRESSIBLE_EXTS = {
+    ".zip", ".7z", ".xz", ".gz", ".bz2", ".zst", ".rar", ".mycmp",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp",
+    ".mp4", ".mkv", ".mov", ".mp3", ".ogg",
+}
+INCOMPRESSIBLE_CLASSES = {"png", "jpeg", "gif", "ogg", "zip", "gzip", "xz", "7z", "zstd", "mycmp"}
+
 # ==========================================
 # 🛠️ ユーティリティ関数
 # ==========================================
@@ -33,8 +68,9 @@ def init_directories():
 
 def clear_workspace():
     """ワークスペースの全ファイルとセッション状態を削除"""
-    if 'scan_result' in st.session_state:
-        del st.session_state['scan_result']
+    for key in ('scan_result', 'hash_cache', 'saved_uploads', 'compress_result'):
+        if key in st.session_state:
+            del st.session_state[key]
     for d in ALL_DIRS:
         if os.path.exists(d): shutil.rmtree(d)
         os.makedirs(d, exist_ok=True)
@@ -45,11 +81,68 @@ def clear_extracted_folder():
         shutil.rmtree(DIR_EXTRACTED)
     os.makedirs(DIR_EXTRACTED, exist_ok=True)
 
+def link_file(src, dst):
+    """ハードリンクでファイルを共有 (同一ファイルシステムならコピー不要)、不可ならコピー"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def save_uploaded_files(uploaded_files, dest_dir):
+    """アップロードされたファイルを1MB単位でディスクへ書き出す (メモリ使用量を抑制)
+    保存済みのアップロードは再実行 (rerun) のたびに書き直さない"""
+    saved_uploads = st.session_state.setdefault('saved_uploads', set())
+    for u in uploaded_files:
+        if u.file_id in saved_uploads:
+            continue
+        u.seek(0)
+        dst = os.path.join(dest_dir, u.name)
+        # ハードリンク先を上書きすると元の出力アーカイブまで書き換わるため、先にリンクを外す
+        if os.path.exists(dst):
+            os.remove(dst)
+        with open(dst, "wb") as f:
+            shutil.copyfileobj(u, f, length=1024 * 1024)
+        saved_uploads.add(u.file_id)
+
+@st.cache_data(show_spinner=False)
+def _count_dir_entries(path, mtime_ns):
+    """ディレクトリ内の項目数 (mtime_nsはキャッシュキー用)"""
+    with os.scandir(path) as it:
+        return sum(1 for _ in it)
+
+def dir_entry_count(path):
+    """ディレクトリ内の項目数を取得 (ディレクトリが変更されるまでキャッシュを再利用)"""
+    return _count_dir_entries(path, os.stat(path).st_mtime_ns)
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_archive_bytes(path, mtime_ns):
+    """作成したアーカイブを読み込む (再実行のたびに読み直さず、保持は最新の1件のみ)"""
+    with open(path, "rb") as f:
+        return f.read()
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def build_extracted_zip(archive_path, archive_mtime_ns, rel_paths):
+    """解凍済みファイルを無圧縮ZIPにまとめる (LZMA解凍済みのため再圧縮しない)
+    キーは解凍元アーカイブと対象ファイル (解凍ファイルのmtimeは常に0のためキーにできない)"""
+    buf = io.BytesIO()
+    # mtimeは圧縮時に0(1970年)へ固定しているため、ZIPの1980年制限を緩和
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED, strict_timestamps=False) as zf:
+        for rel_path in rel_paths:
+            zf.write(os.path.join(DIR_EXTRACTED, rel_path), arcname=rel_path)
+    return buf.getvalue()
+
 class ProgressFileObject:
-    """バイト単位の進捗状況をコールバックするファイルラッパー"""
-    def __init__(self, path, callback):
+    """バイト単位の進捗状況をコールバックするファイルラッパー
+    hasherを渡すと読み込んだデータで同時にハッシュを更新する"""
+    def __init__(self, path, callback, hasher=None):
         self._f = open(path, "rb")
         self._callback = callback
+        self._hasher = hasher
+        if hasattr(os, "posix_fadvise"):
+            # 先頭から順に読むことをカーネルに通知 (先読み強化)
+            os.posix_fadvise(self._f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         self._f.seek(0, os.SEEK_END)
         self._len = self._f.tell()
         self._f.seek(0)
@@ -57,12 +150,44 @@ class ProgressFileObject:
     def read(self, size=-1):
         data = self._f.read(size)
         if data:
+            if self._hasher is not None:
+                self._hasher.update(data)
             self._callback(len(data))
         return data
 
     def close(self):
         self._f.close()
 
+class ProgressReporter:
+    """読み込みバイト数を集計し、バックグラウンドスレッドから0.1秒間隔で進捗表示を更新
+    (読み込みごとの処理は加算のみ。時刻取得やUI更新を行わない)"""
+    def __init__(self, status_area, total_bytes, interval=0.1):
+        self.processed_bytes = 0
+        self._status_area = status_area
+        self._total_bytes = total_bytes
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        add_script_run_ctx(self._thread) # スレッドからStreamlitの要素を更新するため
+
+    def add(self, inc_bytes):
+        self.processed_bytes += inc_bytes
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            if self._total_bytes > 0:
+                processed = self.processed_bytes
+                pct = (processed / self._total_bytes) * 100
+                self._status_area.text(f"Progress: {pct:.1f}% ({processed:,} / {self._total_bytes:,} bytes)")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
 def reset_tar_info(tarinfo):
     """メタデータ（所有者・日時）を削除し、圧縮効率を高める（ノイズ除去）"""
     tarinfo.uid = 0
@@ -72,35 +197,121 @@ def reset_tar_info(tarinfo):
     tarinfo.mtime = 0 # 1970/1/1 固定
     return tarinfo
 
+def calc_dict_size(total_bytes):
+    """入力全体を収める2のべき乗の辞書サイズを算出 (過大な辞書確保を回避)"""
+    dict_size = 1 << max(total_bytes - 1, 0).bit_length()
+    return min(MAX_DICT_SIZE, max(MIN_DICT_SIZE, dict_size))
+
+def build_xz_lzma2_option(lzma_filter):
+    """LZMA2フィルター設定をxzコマンドの --lzma2 オプション文字列に変換"""
+    mf_names = {
+        lzma.MF_HC3: "hc3", lzma.MF_HC4: "hc4",
+        lzma.MF_BT2: "bt2", lzma.MF_BT3: "bt3", lzma.MF_BT4: "bt4",
+    }
+    return (
+        f"preset={lzma_filter['preset']},dict={lzma_filter['dict_size']},"
+        f"lc={lzma_filter['lc']},lp={lzma_filter['lp']},pb={lzma_filter['pb']},"
+        f"nice={lzma_filter['nice_len']},mf={mf_names[lzma_filter['mf']]}"
+    )
+
+@contextmanager
+def open_xz_writer(f_out, filters):
+    """XZ圧縮ストリームの書き込み口を返す
+    xzコマンドがあれば別プロセスにパイプで流し込み (tar化と圧縮を並行させる)、
+    無ければ標準ライブラリのlzmaで圧縮する
+    ※ 辞書サイズは入力全体を収めるため、ブロック分割しても並列化の効果は無く圧縮率が落ちる。
+      -T0はブロック分の入力バッファを確保しメモリ使用量がほぼ倍になるため、-T1で圧縮する"""
+    xz_bin = shutil.which("xz")
+    if xz_bin is None:
+        with lzma.LZMAFile(f_out, "wb", format=lzma.FORMAT_XZ, filters=filters) as lzma_file:
+            yield lzma_file
+        return
+
+    f_out.flush() # マジックナンバーを先に書き出してからxzに出力を引き継ぐ
+    proc = subprocess.Popen(
+        [xz_bin, "-z", "-c", "-T1", f"--lzma2={build_xz_lzma2_option(filters[0])}"],
+        stdin=subprocess.PIPE, stdout=f_out,
+    )
+    try:
+        yield proc.stdin
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"xz exited with code {returncode}")
+
+def magic_class(header):
+    """先頭バイトからファイル形式を分類 (ソートで同種のデータを隣接させるため)"""
+    for signature, name in MAGIC_SIGNATURES:
+        if header.startswith(signature):
+            return name
+    if header.lstrip().startswith((b'{', b'[')):
+        return "json"
+    if header.isascii() and b'\x00' not in header:
+        return "text"
+    return "binary"
+
+def is_incompressible(item):
+    """拡張子・ファイル形式から圧縮済みファイル (画像・動画・アーカイブ) を判定"""
+    return item['ext'].lower() in INCOMPRESSIBLE_EXTS or item['magic'] in INCOMPRESSIBLE_CLASSES
+
+def hash_cache_key(item):
+    """ハッシュキャッシュのキー: (パス, 更新時刻, サイズ)"""
+    return (item['path'], item['mtime_ns'], item['size'])
+
+def new_hasher():
+    """重複排除用のハッシュオブジェクトを生成 (BLAKE3があれば優先、無ければSHA-256)
+    ハッシュはアーカイブに保存されないため、アルゴリズムを変えても互換性に影響しない"""
+    if blake3 is not None:
+        return blake3.blake3()
+    return hashlib.sha256()
+
+def compute_file_hash(fpath):
+    """ファイル全体のハッシュを計算 (重複排除用)"""
+    if blake3 is not None:
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        hasher.update_mmap(fpath)
+        return hasher.hexdigest()
+
+    with open(fpath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha256().hexdigest() # 空ファイルはmmapできない
+        # mmap: ページキャッシュを直接ハッシュし、読み込みバッファへのコピーを省略
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            return hashlib.sha256(mm).hexdigest()
+
 def process_file_metadata(args):
-    """並列処理用: ファイルのハッシュ・ヘッダー・サイズを取得"""
+    """並列処理用: ファイルのヘッダー・サイズを取得 (ハッシュは重複候補のみ後で計算)"""
     fname, input_dir = args
     fpath = os.path.join(input_dir, fname)
     if not os.path.exists(fpath): return None
 
-    size = os.path.getsize(fpath)
-    sha256 = hashlib.sha256()
-    header = b''
-    
+    stat = os.stat(fpath)
     with open(fpath, "rb") as f:
         header = f.read(16) # ソート用に先頭16バイト取得
-        sha256.update(header)
-        while chunk := f.read(1024 * 1024): # 1MBチャンク
-            sha256.update(chunk)
-            
+
     return {
         "name": fname,
         "path": fpath,
-        "size": size,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
         "ext": os.path.splitext(fname)[1],
-        "hash": sha256.hexdigest(),
-        "header": header
+        "hash": None,
+        "header": header,
+        "magic": magic_class(header)
     }
 
 # ==========================================
 # 🚀 圧縮ロジック (Ultimate Logic)
 # ==========================================
 def compress_ultimate(selected_file_names, output_filename="archive"):
+    # 拡張子付きで入力された場合の二重付与 (xxx.mycmp.mycmp) を防止
+    output_filename = output_filename.removesuffix(".mycmp") or "archive"
     output_path = os.path.join(DIR_OUTPUT_ARCHIVE, f"{output_filename}.mycmp")
     status_area = st.empty()
     status_area.info("Status: Initializing Compression Engine...")
@@ -120,47 +331,62 @@ def compress_ultimate(selected_file_names, output_filename="archive"):
                 if i % 5 == 0:
                     pct = int(((i+1)/len(args_list))*100)
                     status_area.text(f"Status: Analyzing Metadata... {pct}%")
+
+        # 重複候補の絞り込み: サイズが一致するファイルのみハッシュで比較
+        # ハッシュは書き込み時の読み込みと同時に計算する (ファイルの読み込みは1回)
+        size_counts = defaultdict(int)
+        for item in file_meta:
+            size_counts[item['size']] += 1
+        dup_sizes = {size for size, count in size_counts.items() if count > 1}
+
+        # ハッシュキャッシュ: (パス, 更新時刻, サイズ) が同じなら再計算しない
+        hash_cache = st.session_state.setdefault('hash_cache', {})
+        for item in file_meta:
+            if item['size'] in dup_sizes:
+                item['hash'] = hash_cache.get(hash_cache_key(item))
         
         # 2. スマートソート (類似データを隣接させ圧縮率向上)
-        # 優先順位: ヘッダーバイナリ > 拡張子 > サイズ
-        sorted_files = sorted(file_meta, key=lambda x: (x['header'], x['ext'], x['size']))
+        # 優先順位: 圧縮済みか > 拡張子 > ファイル形式 > サイズ > 名前
+        # 圧縮済みファイルは末尾へ: 圧縮可能なデータ同士を辞書の範囲内で隣接させる
+        sorted_files = sorted(file_meta, key=lambda x: (
+            is_incompressible(x), x['ext'].lower(), x['magic'], x['size'], x['name']
+        ))
 
         # 3. 圧縮フィルター設定 (安定・最強設定)
-        # メモリ不足回避のため辞書は256MBとし、不安定なBCJフィルターは除外
+        # 辞書は入力サイズに合わせて最大256MBまで、不安定なBCJフィルターは除外
         my_filters = [{
             "id": lzma.FILTER_LZMA2, 
             "preset": 6, 
-            "dict_size": 256 * 1024 * 1024, # 256MB Dictionary
+            "dict_size": calc_dict_size(total_bytes_all), # 1MB ~ 256MB Dictionary
             "lc": 4, "lp": 0, "pb": 2, 
             "nice_len": 273, "mf": lzma.MF_BT4
         }]
         
         # 4. 書き込み実行 (重複排除 + バイト進捗)
-        processed_bytes = 0
-        last_update_time = 0
-        
-        def progress_callback(inc_bytes):
-            nonlocal processed_bytes, last_update_time
-            processed_bytes += inc_bytes
-            current_time = time.time()
-            # 0.1秒間隔でUI更新
-            if current_time - last_update_time > 0.1:
-                if total_bytes_all > 0:
-                    pct = (processed_bytes / total_bytes_all) * 100
-                    status_area.text(f"Progress: {pct:.1f}% ({processed_bytes:,} / {total_bytes_all:,} bytes)")
-                last_update_time = current_time
-
         status_area.text("Status: Starting Compression Stream...")
         time.sleep(0.1)
 
-        with open(output_path, "wb") as f_out:
+        # 既存ファイルは削除してから作成 (ハードリンク先のアーカイブを上書きしないため)
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+        with open(output_path, "wb") as f_out, ProgressReporter(status_area, total_bytes_all) as progress:
             f_out.write(MAGIC_NUMBER)
             
-            with lzma.open(f_out, "w", format=lzma.FORMAT_XZ, filters=my_filters) as lzma_file:
-                with tarfile.open(fileobj=lzma_file, mode="w") as tar:
+            # ストリーミングモード (w|) : tarfile側のseek/tellを排除し、圧縮は別プロセスと並行
+            with open_xz_writer(f_out, my_filters) as xz_stream:
+                with tarfile.open(fileobj=xz_stream, mode="w|", format=tarfile.GNU_FORMAT,
+                                  bufsize=TAR_BUFSIZE, copybufsize=TAR_BUFSIZE) as tar:
                     seen_hashes = {}
+                    written_sizes = set()
                     
                     for item in sorted_files:
+                        is_candidate = item['size'] in dup_sizes
+                        if is_candidate and item['hash'] is None and item['size'] in written_sizes:
+                            # 同サイズの実体が書き込み済み: 比較のため先にハッシュ計算
+                            item['hash'] = compute_file_hash(item['path'])
+                            hash_cache[hash_cache_key(item)] = item['hash']
+
                         if item['hash'] in seen_hashes:
                             # 重複排除: ハードリンク作成 (容量消費ゼロ)
                             ti = tarfile.TarInfo(item['name'])
@@ -169,24 +395,34 @@ def compress_ultimate(selected_file_names, output_filename="archive"):
                             ti = reset_tar_info(ti)
                             tar.addfile(ti)
                         else:
-                            # 実データ書き込み
-                            seen_hashes[item['hash']] = item['name']
+                            # 実データ書き込み (重複候補は読み込みと同時にハッシュ計算)
                             ti = tarfile.TarInfo(name=item['name'])
                             ti.size = item['size']
                             ti = reset_tar_info(ti) # メタデータ削除
                             
-                            fileobj = ProgressFileObject(item['path'], progress_callback)
+                            hasher = new_hasher() if is_candidate and item['hash'] is None else None
+                            fileobj = ProgressFileObject(item['path'], progress.add, hasher)
                             try:
                                 tar.addfile(ti, fileobj=fileobj)
                             finally:
                                 fileobj.close()
 
+                            if is_candidate:
+                                if hasher is not None:
+                                    item['hash'] = hasher.hexdigest()
+                                    hash_cache[hash_cache_key(item)] = item['hash']
+                                seen_hashes[item['hash']] = item['name']
+                                written_sizes.add(item['size'])
+
         status_area.text("Status: 100.0% - Finished!")
         time.sleep(0.5)
         return output_path
 
     except Exception as e:
         status_area.error(f"Critical Error: {e}")
+        # 途中まで書き込んだアーカイブを残さない (ダウンロード・コピーで壊れたファイルを渡さないため)
+        if os.path.exists(output_path):
+            os.remove(output_path)
         return None
 
 # ==========================================
@@ -200,39 +436,79 @@ def list_archive_contents(file_path):
             # 過去バージョンの互換性チェック（前方一致）
             if not magic.startswith(b'MYCP'):
                 return None, "Invalid File Format"
-            compressed_body = f.read()
 
-        with io.BytesIO(compressed_body) as f_in:
-            with lzma.open(f_in, "r", format=lzma.FORMAT_XZ) as lzma_file:
-                with tarfile.open(fileobj=lzma_file, mode="r") as tar:
-                    return tar.getnames(), "Success"
+            # ストリーミング読み込み (r|xz): 圧縮本体をメモリに展開しない
+            with tarfile.open(fileobj=f, mode="r|xz") as tar:
+                return tar.getnames(), "Success"
     except Exception as e:
         return None, str(e)
 
+@st.cache_data(show_spinner=False)
+def scan_archive(file_path, mtime_ns):
+    """list_archive_contents の結果をキャッシュ (同じアーカイブなら再スキャンしない)"""
+    return list_archive_contents(file_path)
+
 def extract_selected_files(file_path, targets):
-    """選択されたファイルのみを解凍"""
+    """選択されたファイルのみを解凍し、書き出したファイルのパス一覧を返す"""
     try:
         clear_extracted_folder()
-        
+        targets = set(targets)
+        extracted = set()
+        extracted_paths = []
+        pending_links = defaultdict(list) # リンク先(未解凍の実体) -> リンクメンバー
+
+        def record(member):
+            extracted.add(member.name)
+            if not member.isdir():
+                extracted_paths.append(os.path.join(DIR_EXTRACTED, member.name))
+
         with open(file_path, "rb") as f:
-            # ヘッダー長分スキップ（バージョンによって長さが違う可能性があるため簡易的に処理）
-            # ここでは現在のMAGIC_NUMBER長で判定
-            f.seek(len(MAGIC_NUMBER)) 
-            compressed_body = f.read()
-
-        with io.BytesIO(compressed_body) as f_in:
-            with lzma.open(f_in, "r", format=lzma.FORMAT_XZ) as lzma_file:
-                with tarfile.open(fileobj=lzma_file, mode="r") as tar:
-                    # 解凍対象フィルター
-                    members = [m for m in tar.getmembers() if m.name in targets]
-                    if not members:
-                        return False, "No matching files found."
-                    
-                    tar.extractall(path=DIR_EXTRACTED, members=members)
-        return True, f"Extracted {len(members)} files."
+            # ヘッダー部分のみ読み込んで判定（本体は読み込まない）
+            magic = f.read(len(MAGIC_NUMBER))
+            if not magic.startswith(b'MYCP'):
+                return False, "Invalid File Format", []
+
+            # ストリーミング解凍 (r|xz): 先頭から順に読み、対象のみ書き出す
+            with tarfile.open(fileobj=f, mode="r|xz") as tar:
+                for member in tar:
+                    if member.name not in targets:
+                        continue
+                    if member.islnk() and member.linkname not in extracted:
+                        # 重複排除リンクの実体が選択外: 2周目で実体を取り出す
+                        pending_links[member.linkname].append(member)
+                    else:
+                        tar.extract(member, path=DIR_EXTRACTED)
+                        record(member)
+                    if len(extracted) + sum(map(len, pending_links.values())) == len(targets):
+                        break # 残りは読み飛ばす
+
+        if pending_links:
+            with open(file_path, "rb") as f:
+                f.seek(len(MAGIC_NUMBER))
+                with tarfile.open(fileobj=f, mode="r|xz") as tar:
+                    for member in tar:
+                        links = pending_links.pop(member.name, None)
+                        if links is None:
+                            continue
+                        # 最初のリンク名で実体を書き出し、残りはそこへのリンクにする
+                        first, *rest = links
+                        data_member = copy.copy(member)
+                        data_member.name = first.name
+                        tar.extract(data_member, path=DIR_EXTRACTED)
+                        record(first)
+                        for link in rest:
+                            link.linkname = first.name
+                            tar.extract(link, path=DIR_EXTRACTED)
+                            record(link)
+                        if not pending_links:
+                            break
+
+        if not extracted:
+            return False, "No matching files found.", []
+        return True, f"Extracted {len(extracted)} files.", extracted_paths
 
     except Exception as e:
-        return False, f"Extraction Error: {e}"
+        return False, f"Extraction Error: {e}", []
 
 # ==========================================
 # 🖥️ UI (Streamlit)
@@ -240,13 +516,17 @@ def extract_selected_files(file_path, targets):
 st.set_page_config(page_title="Ultra Compressor V13", layout="wide")
 init_directories()
 
+# 再実行前に予約されたトースト通知を表示
+if 'pending_toast' in st.session_state:
+    st.toast(st.session_state.pop('pending_toast'), icon="✅")
+
 st.title(f"🗜️ Ultra Compressor {VERSION_LABEL}")
 st.markdown("""
 <style>
 div.stButton > button {width: 100%; border-radius: 6px; font-weight: bold;}
 </style>
 """, unsafe_allow_html=True)
-st.caption("Features: 256MB Dict | Deduplication | Metadata Stripping | Smart Sort | Selective Extract")
+st.caption("Features: Up to 256MB Dict | Deduplication | Metadata Stripping | Smart Sort | Selective Extract")
 
 # サイドバー
 with st.sidebar:
@@ -256,10 +536,10 @@ with st.sidebar:
         st.rerun()
     
     st.divider()
-    st.info(f"Input Raw: {len(os.listdir(DIR_INPUT_RAW))}")
-    st.info(f"Archives: {len(os.listdir(DIR_OUTPUT_ARCHIVE))}")
-    st.info(f"Input Comp: {len(os.listdir(DIR_INPUT_COMPRESSED))}")
-    st.info(f"Extracted: {len(os.listdir(DIR_EXTRACTED))}")
+    st.info(f"Input Raw: {dir_entry_count(DIR_INPUT_RAW)}")
+    st.info(f"Archives: {dir_entry_count(DIR_OUTPUT_ARCHIVE)}")
+    st.info(f"Input Comp: {dir_entry_count(DIR_INPUT_COMPRESSED)}")
+    st.info(f"Extracted: {dir_entry_count(DIR_EXTRACTED)}")
 
 tab_compress, tab_decompress = st.tabs(["📤 Compress (圧縮)", "📥 Decompress (選択解凍)"])
 
@@ -271,11 +551,12 @@ with tab_compress:
         st.subheader("1. Add Files")
         uploaded = st.file_uploader("Upload raw files", accept_multiple_files=True, key="up_c")
         if uploaded:
-            for u in uploaded:
-                with open(os.path.join(DIR_INPUT_RAW, u.name), "wb") as f:
-                    f.write(u.getbuffer())
+            save_uploaded_files(uploaded, DIR_INPUT_RAW)
         
-        files = sorted(os.listdir(DIR_INPUT_RAW))
+        # scandir: 一覧取得時のエントリを保持し、サイズ計算で再利用
+        with os.scandir(DIR_INPUT_RAW) as it:
+            raw_entries = {e.name: e for e in it if e.is_file()}
+        files = sorted(raw_entries)
         if files:
             st.write("---")
             selected = st.multiselect("Select files", files, default=files, key="sel_c")
@@ -292,27 +573,40 @@ with tab_compress:
             result_path = compress_ultimate(selected, out_name)
             
             if result_path:
-                elapsed = time.time() - start_time
-                orig_sz = sum(os.path.getsize(os.path.join(DIR_INPUT_RAW, f)) for f in selected)
-                comp_sz = os.path.getsize(result_path)
-                red_pct = (1 - (comp_sz / orig_sz)) * 100 if orig_sz > 0 else 0
-                
+                orig_sz = sum(raw_entries[f].stat().st_size for f in selected)
+                # 結果はセッションに保持し、ボタン分岐の外で表示 (Copyボタン押下後の再実行でも残す)
+                st.session_state['compress_result'] = {
+                    'path': result_path,
+                    'elapsed': time.time() - start_time,
+                    'orig_sz': orig_sz,
+                    'comp_sz': os.path.getsize(result_path),
+                }
                 st.balloons()
-                st.success(f"Completed in {elapsed:.2f} seconds!")
-                
-                m1, m2, m3 = st.columns(3)
-                m1.metric("Original", f"{orig_sz:,} B")
-                m2.metric("Compressed", f"{comp_sz:,} B")
-                m3.metric("Reduction", f"{red_pct:.2f}%")
-                
-                with open(result_path, "rb") as f:
-                    st.download_button("⬇️ Download (.mycmp)", f, file_name=os.path.basename(result_path), key="dl_c")
-                
-                if st.button("🔄 Copy to Decompress Tab", key="cp_c"):
-                    shutil.copy2(result_path, os.path.join(DIR_INPUT_COMPRESSED, os.path.basename(result_path)))
-                    st.toast("Copied successfully!", icon="✅")
-                    time.sleep(1)
-                    st.rerun()
+            else:
+                # 失敗時は前回の結果を表示し続けない
+                st.session_state.pop('compress_result', None)
+
+        result = st.session_state.get('compress_result')
+        if result and os.path.exists(result['path']):
+            result_path = result['path']
+            orig_sz, comp_sz = result['orig_sz'], result['comp_sz']
+            red_pct = (1 - (comp_sz / orig_sz)) * 100 if orig_sz > 0 else 0
+
+            st.success(f"Completed in {result['elapsed']:.2f} seconds!")
+
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Original", f"{orig_sz:,} B")
+            m2.metric("Compressed", f"{comp_sz:,} B")
+            m3.metric("Reduction", f"{red_pct:.2f}%")
+
+            archive_bytes = load_archive_bytes(result_path, os.stat(result_path).st_mtime_ns)
+            st.download_button("⬇️ Download (.mycmp)", archive_bytes, file_name=os.path.basename(result_path), key="dl_c")
+
+            if st.button("🔄 Copy to Decompress Tab", key="cp_c"):
+                link_file(result_path, os.path.join(DIR_INPUT_COMPRESSED, os.path.basename(result_path)))
+                # 待機せず再実行し、トーストは次の実行で表示
+                st.session_state['pending_toast'] = "Copied successfully!"
+                st.rerun()
 
 # === 解凍タブ (選択解凍) ===
 with tab_decompress:
@@ -322,11 +616,10 @@ with tab_decompress:
         st.subheader("1. Load & Scan")
         up_arc = st.file_uploader("Upload .mycmp file", accept_multiple_files=True, type=None, key="up_d")
         if up_arc:
-            for u in up_arc:
-                with open(os.path.join(DIR_INPUT_COMPRESSED, u.name), "wb") as f:
-                    f.write(u.getbuffer())
+            save_uploaded_files(up_arc, DIR_INPUT_COMPRESSED)
         
-        archives = sorted(os.listdir(DIR_INPUT_COMPRESSED))
+        with os.scandir(DIR_INPUT_COMPRESSED) as it:
+            archives = sorted(e.name for e in it if e.is_file())
         target_arc = st.selectbox("Select Archive", archives, key="sel_d") if archives else None
 
         # スキャンボタン
@@ -334,7 +627,8 @@ with tab_decompress:
         
         if scan_btn and target_arc:
             with st.spinner("Scanning archive structure..."):
-                contents, msg = list_archive_contents(os.path.join(DIR_INPUT_COMPRESSED, target_arc))
+                arc_path = os.path.join(DIR_INPUT_COMPRESSED, target_arc)
+                contents, msg = scan_archive(arc_path, os.stat(arc_path).st_mtime_ns)
                 if contents is not None:
                     st.session_state['scan_result'] = {'archive': target_arc, 'files': contents}
                     st.success(f"Found {len(contents)} files.")
@@ -354,25 +648,17 @@ with tab_decompress:
             if st.button("🔓 Extract Selected", disabled=not selected_extract, key="btn_ext"):
                 target_path = os.path.join(DIR_INPUT_COMPRESSED, target_arc)
                 with st.spinner("Extracting..."):
-                    success, msg = extract_selected_files(target_path, selected_extract)
+                    success, msg, extracted_files = extract_selected_files(target_path, selected_extract)
                 
                 if success:
                     st.success(f"✅ {msg}")
                     
-                    extracted_files = []
-                    for root, dirs, files in os.walk(DIR_EXTRACTED):
-                        for file in files:
-                            extracted_files.append(os.path.join(root, file))
-                    
                     if extracted_files:
                         st.write(f"**Extracted Output ({len(extracted_files)}):**")
-                        with st.container(height=300):
-                            for path in extracted_files:
-                                rel_path = os.path.relpath(path, DIR_EXTRACTED)
-                                col_name, col_dl = st.columns([3, 1])
-                                col_name.text(rel_path)
-                                with open(path, "rb") as f:
-                                    col_dl.download_button("⬇️", f, file_name=os.path.basename(path), key=f"dl_{rel_path}")
+                        rel_paths = tuple(os.path.relpath(path, DIR_EXTRACTED) for path in extracted_files)
+                        zip_bytes = build_extracted_zip(target_path, os.stat(target_path).st_mtime_ns, rel_paths)
+                        st.download_button("⬇️ Download All (.zip)", zip_bytes,
+                                           file_name="extracted.zip", mime="application/zip", key="dl_zip")
                 else:
                     st.error(f"❌ {msg}")
         